@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 from __future__ import print_function
 import sys
-from string import Template
+from string import Template, Formatter
 import math
+import re
 import json
+import os
 
 ################################################################################
 ### Settings ###################################################################
@@ -70,8 +72,46 @@ G92 E0.0
 """
 };
 
+# the generated g-code is accumulated here and written out by flush_output()
+out = [];
+
+def output(s):
+    out.append(s);
+    out.append("\n");
+
+# writes the accumulated g-code with a single write
+def flush_output():
+    # write the encoded g-code straight to the underlying binary stream,
+    # keeping the newline translation text mode would do
+    gcode = "".join(out);
+    if os.linesep != "\n":
+        gcode = gcode.replace("\n", os.linesep);
+    sys.stdout.flush();
+    sys.stdout.buffer.write(gcode.encode(sys.stdout.encoding or "utf-8"));
+    del out[:];
+
 def comment(s):
-    return str(s).replace("\n", "\n;     ")
+    s = str(s);
+    # most of the values are single line, no need to copy those
+    if "\n" not in s:
+        return s;
+    return s.replace("\n", "\n;     ")
+
+# converts a string.Template style text ($name or ${name}) to a str.format one
+def format_template(text):
+    parts = [];
+    pos = 0;
+    for m in Template.pattern.finditer(text):
+        parts.append(text[pos:m.start()].replace("{", "{{").replace("}", "}}"));
+        if m.group("escaped") is not None:
+            parts.append("$");
+        elif m.group("invalid") is not None:
+            raise ValueError("invalid placeholder in template: %s" % text);
+        else:
+            parts.append("{%s}" % (m.group("named") or m.group("braced")));
+        pos = m.end();
+    parts.append(text[pos:].replace("{", "{{").replace("}", "}}"));
+    return "".join(parts);
 
 def load_overrides(filename):
     try:
@@ -79,17 +119,17 @@ def load_overrides(filename):
         settings.update(json.load(foverrides));
     except FileNotFoundError:
         # not a problem
-        print("; NOTE: no %s config file found - skipping" % filename);
+        output("; NOTE: no %s config file found - skipping" % filename);
         pass
 
 ################################################################################
 ### Print introductionary header, load overrides ###############################
 ################################################################################
-print("; #############################################");
-print("; generated by retraction-seeker.py");
-print("; http://github.com/volca02/retraction-seeker/");
-print("; #############################################");
-print("; ");
+output("; #############################################");
+output("; generated by retraction-seeker.py");
+output("; http://github.com/volca02/retraction-seeker/");
+output("; #############################################");
+output("; ");
 
 # override settings by reading machine.json followed by settings.json
 load_overrides("machine.json");
@@ -102,97 +142,118 @@ load_overrides("settings.json");
 
 # global settings for the generated g-code
 # a modified version of a prusa prologue
-gcode_prologue = Template("""
+gcode_prologue = """
 ;
 ; PROLOGUE
 ; ################
 ; settings:
-$settings
+{settings}
 ; ################
 
 M73 P0 R86
 M73 Q0 S86
-M201 X$accel_x Y$accel_y Z$accel_z E$accel_e
-M203 X$feed_x Y$feed_y Z$feed_z E$feed_e ; sets maximum feedrates, mm/sec
+M201 X{accel_x} Y{accel_y} Z{accel_z} E{accel_e}
+M203 X{feed_x} Y{feed_y} Z{feed_z} E{feed_e} ; sets maximum feedrates, mm/sec
 M205 S0 T0 ; sets the minimum extruding and travel feed rate, mm/sec
 M107
 M83  ; extruder relative mode
-M104 S$temp_nozzle ; set extruder temp
-M140 S$temp_bed    ; set bed temp
-M190 S$temp_bed    ; wait for bed temp
-M109 S$temp_nozzle ; wait for extruder temp
+M104 S{temp_nozzle} ; set extruder temp
+M140 S{temp_bed}    ; set bed temp
+M190 S{temp_bed}    ; wait for bed temp
+M109 S{temp_nozzle} ; wait for extruder temp
 G28 ; home all axes
-$gcode_intro_abl
-$gcode_intro_prime
+{gcode_intro_abl}
+{gcode_intro_prime}
 M221 S95
 M900 K30; Filament gcode
 G21 ; set units to millimeters
 G90 ; use absolute coordinates
 M83 ; use relative distances for extrusion
 
-""");
+""";
 
-gcode_epilogue = Template("""; EPILOGUE
+gcode_epilogue = """; EPILOGUE
 G4 ; wait
 M221 S100
 M104 S0 ; turn off temperature
 M140 S0 ; turn off heatbed
 M107 ; turn off fan
-G1 Z$park_z ; Move print head up
+G1 Z{park_z} ; Move print head up
 G1 X0 Y200; home X axis
 M84 ; disable motors
-""")
+"""
 
 # every Z tile we output this prologue (ie. not every layer!)
 # by default it sets the current temperature without blocking
 # could be commented out to leave the temperature stable - that would enable
 # using Z-hop search on Z tile direction
-z_tile_prologue = Template("""; -----------------
-; Z tile layer $z_tile
-; nozzle_temp = $temp_nozzle
-M104 S$temp_nozzle ; nozzle temp
-""");
+z_tile_prologue = """; -----------------
+; Z tile layer {z_tile}
+; nozzle_temp = {temp_nozzle}
+M104 S{temp_nozzle} ; nozzle temp
+""";
 
 # this is a fairly standard layer prologue
-z_layer_prologue = Template("""
+z_layer_prologue = """
 ;AFTER_LAYER_CHANGE
-;$coord_z
-$fan_spd_cmd ; fan speed (or fan off)
-G1 Z$coord_z F$feed_z_m ; change the z-coord
-""");
+;{coord_z}
+{fan_spd_cmd} ; fan speed (or fan off)
+G1 Z{coord_z} F{feed_z_m} ; change the z-coord
+""";
 
 # for every tile we generate this prologue
 # note: could be use to set settings for firmware retraction
-tile_prologue = Template("""; tile x=$tile_x y=$tile_y z=$tile_z
-; tile pos x=$tile_origin_x y=$tile_origin_y z=$tile_origin_z
+tile_prologue = """; tile x={tile_x} y={tile_y} z={tile_z}
+; tile pos x={tile_origin_x} y={tile_origin_y} z={tile_origin_z}
 ; retraction settings:
-;     distance = $deret_d mm
-;     speed    = $ret_spd mm/s
-; nozzle_temp  = $temp_nozzle
-""");
+;     distance = {deret_d} mm
+;     speed    = {ret_spd} mm/s
+; nozzle_temp  = {temp_nozzle}
+""";
 
-gcode_retract = "G1 E$ret_d F$ret_feed ; retract";
-gcode_deretract = "G1 E$last_ret_d F$ret_feed ; deretract";
+gcode_retract = "G1 E{ret_d} F{ret_feed} ; retract";
+gcode_deretract = "G1 E{last_ret_d} F{ret_feed} ; deretract";
 
 if settings["ret_z_hop"] > 0.001:
-    gcode_retract = "G1 Z$coord_z_hop F$feed_z_ret ; z-hop\nG1 E$ret_d F$ret_feed ; retract";
-    gcode_deretract = "G1 Z$coord_z F$feed_z_ret; z-unhop\nG1 E$last_ret_d F$ret_feed ; deretract";
+    gcode_retract = "G1 Z{coord_z_hop} F{feed_z_ret} ; z-hop\nG1 E{ret_d} F{ret_feed} ; retract";
+    gcode_deretract = "G1 Z{coord_z} F{feed_z_ret}; z-unhop\nG1 E{last_ret_d} F{ret_feed} ; deretract";
 
 # retraction/derectraction templates. Overridable in settings file
-retract_template = Template(settings.get("gcode_retract", gcode_retract));
+# (the overrides use the $name syntax, so convert those)
+retract_template = format_template(settings["gcode_retract"]) if "gcode_retract" in settings else gcode_retract;
 # retraction/derectraction templates.
-deretract_template = Template(settings.get("gcode_deretract", gcode_deretract));
-
-travel_template = Template("""G1 X$travel_x Y$travel_y F$feed_travel ; travel
-""");
+deretract_template = format_template(settings["gcode_deretract"]) if "gcode_deretract" in settings else gcode_deretract;
+
+# settings that change from layer to layer, but stay the same for all the tiles
+# of a layer. Templates not using any of these only depend on the x/y tile and
+# are rendered ahead of time. Filled by prerender_tiles()
+layer_keys = set();
+# settings describing the print head position. These change within a tile,
+# templates using them are rendered on every call. Filled by prerender_tiles()
+head_keys = set();
+
+# prerendered tile g-code, filled by prerender_tiles()
+# RETRACT_STR[y][x], DERETRACT_STR[y][x of the retracted tile], TILE_PROLOGUE_STR[z][y][x]
+RETRACT_STR = [];
+DERETRACT_STR = [];
+TILE_PROLOGUE_STR = [];
+# SHAPE_STR[y][x] and SHAPE_STR_INTRO[y][x] - tuples from render_shape()
+SHAPE_STR = [];
+SHAPE_STR_INTRO = [];
+# LAYER_PROLOGUE_STR[layer] - filled by prerender_layers()
+LAYER_PROLOGUE_STR = [];
 
 ################################################################################
 ### Recalculation functions ####################################################
 ################################################################################
 
+# tile origins, TILE_ORIGIN_X[x] and TILE_ORIGIN_Y[y], filled by recalculate_constants()
+TILE_ORIGIN_X = [];
+TILE_ORIGIN_Y = [];
+
 # these update some of the values in the settings to reflect the current status
 def recalculate_z_tile(z):
-    settings["temp_nozzle"] = settings["ret_temp_start"] + settings["ret_temp_step"] * settings["z_tile"];
+    settings["temp_nozzle"] = settings["ret_temp_start"] + settings["ret_temp_step"] * z;
     # this is just informative z_tile origin, it changes in tile steps in z direction (for measuring purposes on Z axis [mm])
     settings["tile_origin_z"] = z * settings["ret_temp_step_h"] * settings["layer_height"];
 
@@ -203,16 +264,17 @@ def recalculate_layer(layer):
     settings["coord_z_hop"] = coord_z + settings["ret_z_hop"];
 
     if (layer == 0):
-        fan_spd = settings["fan_spd_initial"];
+        settings["fan_spd"] = settings["fan_spd_initial"];
+        settings["fan_spd_cmd"] = FAN_CMD_LAYER0;
     else:
-        fan_spd = settings["fan_spd_other"];
+        settings["fan_spd"] = settings["fan_spd_other"];
+        settings["fan_spd_cmd"] = FAN_CMD_OTHER;
 
+# g-code setting the given fan speed
+def fan_cmd(fan_spd):
     if fan_spd == 0:
-        settings["fan_spd_cmd"] = "M107";
-    else:
-        settings["fan_spd_cmd"] = "M106 S%d" % fan_spd;
-
-    settings["fan_spd"] = fan_spd;
+        return "M107";
+    return "M106 S%d" % fan_spd;
 
 # given tile coordinates, recalculate origin of the tile (coord_x, coord_y) and retraction settings
 def recalculate_tile_settings(x,y,z):
@@ -227,9 +289,9 @@ def recalculate_tile_settings(x,y,z):
     settings["ret_spd"] = settings["ret_spd_start"] + settings["ret_spd_step"] * y;
     settings["ret_feed"] = settings["ret_spd"] * 60; # feedrate is in mm/m
 
-    # calculate the origin of the tile
-    settings["tile_origin_x"] = settings["tile_x_start"] + x * settings["tile_x_step"];
-    settings["tile_origin_y"] = settings["tile_y_start"] + y * settings["tile_y_step"];
+    # origin of the tile
+    settings["tile_origin_x"] = TILE_ORIGIN_X[x];
+    settings["tile_origin_y"] = TILE_ORIGIN_Y[y];
 
 # recalculates bed tile positioning, extrusion multiplier, etc
 def recalculate_constants():
@@ -253,6 +315,10 @@ def recalculate_constants():
     settings["tile_x_step"] = tile_x_step;
     settings["tile_y_step"] = tile_y_step;
 
+    # origins of the tiles in both directions
+    TILE_ORIGIN_X[:] = [margin_x + x * tile_x_step for x in range(0, settings["steps_x"])];
+    TILE_ORIGIN_Y[:] = [margin_y + y * tile_y_step for y in range(0, settings["steps_y"])];
+
     # insert tuple of all ret_d and ret_spd and temp_nozzle
     settings["ret_d_steps"] = [(settings["ret_d_start"] + settings["ret_d_step"] * (x-1)) for x in range(1, settings["steps_x"])]
     settings["ret_spd_steps"] = [(settings["ret_spd_start"] + settings["ret_spd_step"] * (y-1)) for y in range(1, settings["steps_x"])]
@@ -289,6 +355,167 @@ def recalculate_constants():
     # we generate 0.027650062000232345, slic3r uses 0.02565799325936893
     settings["e_per_mm"] = mm3_per_mm / filament_area;
 
+def template_fields(template):
+    return {f[1] for f in Formatter().parse(template) if f[1]};
+
+# rebuilds the replacement field as found in the template
+def placeholder(field, spec, conv):
+    return "{" + field + ("!" + conv if conv else "") + (":" + spec if spec else "") + "}";
+
+# renders the template, leaving the fields from keep as placeholders. The
+# result is a template again (unless keep is empty, then it is the final text)
+def partial_format(template, keep):
+    if not keep:
+        return template.format_map(settings);
+
+    parts = [];
+    for literal, field, spec, conv in Formatter().parse(template):
+        parts.append(literal.replace("{", "{{").replace("}", "}}"));
+        if field is None:
+            continue;
+
+        name = re.split(r"[.\[]", field)[0];
+        field = placeholder(field, spec, conv);
+        if name in keep:
+            parts.append(field);
+        else:
+            parts.append(field.format_map(settings).replace("{", "{{").replace("}", "}}"));
+
+    return "".join(parts);
+
+# splits the template into its literal text and the fields following each of
+# the literals, so that it can be rendered repeatedly without parsing it again
+def compile_template(template):
+    literals = [];
+    fields = [];
+    for literal, field, spec, conv in Formatter().parse(template):
+        literals.append(literal);
+        fields.append(None if field is None else placeholder(field, spec, conv));
+    return (literals, fields);
+
+# renders a template from compile_template() - every distinct field is only
+# formatted once
+def render_compiled(compiled):
+    literals, fields = compiled;
+    values = {f: f.format_map(settings) for f in set(fields) if f is not None};
+    values[None] = "";
+
+    parts = [None] * (2 * len(literals));
+    parts[0::2] = literals;
+    parts[1::2] = [values[f] for f in fields];
+    return "".join(parts);
+
+# a settings dict remembering which keys were written to it
+class KeyRecorder(dict):
+    def __init__(self, *args):
+        dict.__init__(self, *args);
+        self.written = set();
+
+    def __setitem__(self, key, value):
+        self.written.add(key);
+        dict.__setitem__(self, key, value);
+
+# calls fn on a copy of the settings, returns the settings keys it writes
+def written_keys(fn, *args):
+    global settings;
+    saved = settings;
+    settings = KeyRecorder(saved);
+    try:
+        fn(*args);
+        return settings.written;
+    finally:
+        settings = saved;
+
+# renders the per-tile templates for all the tiles, so that the main loop only
+# needs to index into the tables
+def prerender_tiles():
+    steps_x = settings["steps_x"];
+    steps_y = settings["steps_y"];
+
+    # whatever the per layer recalculation and the travels write, plus the z
+    # tile indices set by the main loop and by recalculate_tile_settings()
+    layer_keys.update(written_keys(recalculate_layer, 0));
+    layer_keys.update(written_keys(recalculate_z_tile, 0));
+    layer_keys.update(("z_tile", "z_tile_intro", "tile_z"));
+    head_keys.update(written_keys(generate_travel, 0, 0));
+
+    # the rendering goes through the settings of every tile, so put the
+    # settings back as they were when done
+    saved = dict(settings);
+
+    for z in range(0, settings["steps_z"]):
+        settings["z_tile"] = z;
+        recalculate_z_tile(z);
+        plane = [];
+        for y in range(0, steps_y):
+            row = [];
+            for x in range(0, steps_x):
+                recalculate_tile_settings(x, y, z);
+                row.append(tile_prologue.format_map(settings));
+            plane.append(row);
+        TILE_PROLOGUE_STR.append(plane);
+
+    # the shapes are the same for all the layers, apart from the z tile intro
+    for y in range(0, steps_y):
+        row = [];
+        row_intro = [];
+        for x in range(0, steps_x):
+            recalculate_tile_settings(x, y, 0);
+            row.append(render_shape(0));
+            row_intro.append(render_shape(0.08));
+        SHAPE_STR.append(row);
+        SHAPE_STR_INTRO.append(row_intro);
+
+    retract_fields = template_fields(retract_template);
+    deretract_fields = template_fields(deretract_template);
+
+    # deretraction happens on the next tile, so only the retraction distance
+    # comes from the retracted tile (x), the rest has to be from the current one
+    if deretract_fields & {"tile_x", "tile_origin_x", "ret_d", "deret_d"}:
+        keep = None;
+    elif (retract_fields | deretract_fields) & head_keys:
+        # the head position changes within a tile, render on every call
+        keep = None;
+    elif (retract_fields | deretract_fields) & layer_keys:
+        # per layer settings are kept as placeholders, the whole layer is
+        # then rendered in one go
+        keep = layer_keys;
+    else:
+        keep = set();
+
+    if keep is not None or not (retract_fields & (layer_keys | head_keys)):
+        settings["last_ret_d"] = 0;
+        for y in range(0, steps_y):
+            row = [];
+            for x in range(0, steps_x):
+                recalculate_tile_settings(x, y, 0);
+                row.append(partial_format(retract_template, keep or set()) + "\n");
+            RETRACT_STR.append(row);
+
+    if keep is not None:
+        for y in range(0, steps_y):
+            row = [];
+            for x in range(0, steps_x):
+                recalculate_tile_settings(x, y, 0);
+                settings["last_ret_d"] = -settings["ret_d"];
+                row.append(partial_format(deretract_template, keep) + "\n");
+            DERETRACT_STR.append(row);
+
+    settings.clear();
+    settings.update(saved);
+
+    # whether the tables contain placeholders to be filled in per layer
+    return bool(keep);
+
+# renders the layer prologues for all the layers of the print
+def prerender_layers():
+    saved = dict(settings);
+    for layer in range(0, settings["steps_z"] * settings["ret_temp_step_h"]):
+        recalculate_layer(layer);
+        LAYER_PROLOGUE_STR.append(z_layer_prologue.format_map(settings));
+    settings.clear();
+    settings.update(saved);
+
 ################################################################################
 ### G-code generators ##########################################################
 ################################################################################
@@ -300,8 +527,12 @@ def generate_retract():
     gcode = ""
 
     if (current_ret == 0) and (abs(ret_d) > 0.001):
-        gcode = retract_template.substitute(settings) + "\n"
+        if RETRACT_STR:
+            gcode = RETRACT_STR[settings["tile_y"]][settings["tile_x"]];
+        else:
+            gcode = retract_template.format_map(settings) + "\n"
         settings["last_ret_d"] = -ret_d;
+        settings["last_ret_x"] = settings["tile_x"];
 
     return gcode;
 
@@ -311,49 +542,49 @@ def generate_deretract():
     gcode = "";
 
     if (current_ret != 0):
-        gcode = deretract_template.substitute(settings) + "\n";
+        if DERETRACT_STR:
+            gcode = DERETRACT_STR[settings["tile_y"]][settings["last_ret_x"]];
+        else:
+            gcode = deretract_template.format_map(settings) + "\n";
         settings["last_ret_d"] = 0;
 
     return gcode;
 
-# generates extruding line from initial to given coordinates
-def generate_extrude_line(x, y, feed):
-    px = settings["pos_x"];
-    py = settings["pos_y"];
-
-    # extrusion multiplier per mm of travel
-    e_per_mm = settings["e_per_mm"];
-
-    d_x = x - px;
-    d_y = y - py;
+# all the lines we extrude are axis aligned, so the length of the line is just
+# the difference in the one coordinate that changes
+# feed_cmd is the preformatted feedrate suffix (see PRINT_FEED_CMD and friends)
 
-    # calculate the travel distance
-    travel = math.sqrt(d_x*d_x + d_y*d_y);
+# generates extruding line along the x axis, from pos_x to the given coordinates
+def generate_extrude_x(pos_x, x, y, e_per_mm, feed_cmd):
+    e = abs(x - pos_x) * e_per_mm;
+    return "G1 X%.6f Y%.6f E%.6f" % (x,y,e) + feed_cmd;
 
-    # calculate extrusion distance from travel distance
-    e = travel * e_per_mm;
-
-    # update current position
-    settings["pos_x"] = x;
-    settings["pos_y"] = y;
+# generates extruding line along the y axis, from pos_y to the given coordinates
+def generate_extrude_y(pos_y, x, y, e_per_mm, feed_cmd):
+    e = abs(y - pos_y) * e_per_mm;
+    return "G1 X%.6f Y%.6f E%.6f" % (x,y,e) + feed_cmd;
 
-    return "G1 X%3.6f Y%3.6f E%3.6f F%3.6f\n" % (x,y,e,feed);
+# formats the given numbers the way the extrusion lines use them (6 decimals)
+def format_coords(*values):
+    return ["%.6f" % v for v in values];
 
 def generate_travel(x, y):
+    # the retraction templates may refer to these
     settings["travel_x"] = x;
     settings["travel_y"] = y;
-    travel = travel_template.substitute(settings);
     settings["pos_x"] = x;
     settings["pos_y"] = y;
-    return travel
+    return f"G1 X{x} Y{y}" + TRAVEL_FEED_CMD;
 
+# returns the lines of the brim of the current tile
 def generate_brim():
     origin_x = settings["tile_origin_x"];
     origin_y = settings["tile_origin_y"];
     pad_w    = settings["brim_width"];
-    feed     = settings["feed_print_first"];
+    feed     = FIRST_FEED_CMD;
     square_size = settings["square_size"];
     lw = settings["line_width"];
+    e_per_mm = settings["e_per_mm"];
 
     x1 = origin_x - pad_w;
     y1 = origin_y - pad_w;
@@ -364,39 +595,41 @@ def generate_brim():
     lines = int((x2 - x1) / (2*lw));
 
     # zigzag extrude from
-    gcode = generate_travel(x1,y1);
+    gcode = [generate_travel(x1,y1)];
+    pos_x = x1;
 
     # de-retract
-    gcode += generate_deretract();
+    gcode.append(generate_deretract());
 
     for l in range(0, lines):
         x = x1 + l * lw * 2;
-        gcode += generate_extrude_line(x,y2,feed);
-        gcode += generate_extrude_line(x + lw, y2,feed);
-        gcode += generate_extrude_line(x + lw, y1,feed);
+        gcode.append(generate_extrude_y(y1, x, y2, e_per_mm, feed));
+        gcode.append(generate_extrude_x(x, x + lw, y2, e_per_mm, feed));
+        gcode.append(generate_extrude_y(y2, x + lw, y1, e_per_mm, feed));
+        pos_x = x + lw;
         if (l + 1 < lines):
-            gcode += generate_extrude_line(x + 2*lw, y1,feed);
+            gcode.append(generate_extrude_x(x + lw, x + 2*lw, y1, e_per_mm, feed));
+            pos_x = x + 2*lw;
+
+    settings["pos_x"] = pos_x;
+    settings["pos_y"] = y1;
+    return gcode;
 
-    return gcode
+def head_state():
+    return {k: settings[k] for k in head_keys};
 
-def generate_shape():
+# renders the shape for the current tile. Returns the travel to the shape's
+# start and the extrusion of the shape itself - deretraction goes in between -
+# along with the head position after the travel and at the end of the shape
+def render_shape(shrink):
     origin_x = settings["tile_origin_x"];
     origin_y = settings["tile_origin_y"];
-    feed     = settings["feed_print"];
-    feed_o   = settings["feed_print_outer"];
-
-    # first layer contains brim
-    if settings["layer"] == 0:
-        return generate_brim();
-
-    # first positioning, then the rest is moving extruder too
-    gcode = "";
+    feed     = PRINT_FEED_CMD;
+    feed_o   = OUTER_FEED_CMD;
+    e_per_mm = settings["e_per_mm"];
 
-    # is this z tile intro?
-    z_intro = settings["z_tile_intro"];
-    shrink = 0;
-    if (z_intro): # small shrink in shape to serve as marker
-        shrink = 0.08;
+    travel = None;
+    gcode = [];
 
     # we generate a simple square in rising coordinates
     # size is governed by setting square_size
@@ -414,38 +647,104 @@ def generate_shape():
 
     # inner square, if appropriate
     if (square_size - 2*lw >= 2*lw):
+        x1 = origin_x + s;
+        y1 = origin_y + s;
+        x2 = far_x - s;
+        y2 = far_y - s;
+        # all the edges are of the same length, so is the extrusion.
+        # every number is used twice, so it is formatted just once
+        fx1, fy1, fx2, fy2, fe_x, fe_y = format_coords(x1, y1, x2, y2, abs(x2 - x1) * e_per_mm, abs(y2 - y1) * e_per_mm);
+
         # feedrate to travel speed
         # short travel to origin again
-        gcode += generate_travel(origin_x + s, origin_y + s);
-        # de-retract
-        gcode += generate_deretract();
+        travel = generate_travel(x1, y1);
+        start = head_state();
         # feedrate to print speed
-        gcode += generate_extrude_line(far_x - s,    origin_y + s, feed);
-        gcode += generate_extrude_line(far_x - s,    far_y - s, feed);
-        gcode += generate_extrude_line(origin_x + s, far_y - s, feed);
-        gcode += generate_extrude_line(origin_x + s, origin_y + s, feed);
+        gcode.append("G1 X" + fx2 + " Y" + fy1 + " E" + fe_x + feed);
+        gcode.append("G1 X" + fx2 + " Y" + fy2 + " E" + fe_y + feed);
+        gcode.append("G1 X" + fx1 + " Y" + fy2 + " E" + fe_x + feed);
+        gcode.append("G1 X" + fx1 + " Y" + fy1 + " E" + fe_y + feed);
 
     # TODO: when set, generate infill, etc (complex, so I'm not bothering right now)
 
     # outer shell now
     s = lw + shrink;
 
+    x1 = origin_x + s;
+    y1 = origin_y + s;
+    x2 = far_x - s;
+    y2 = far_y - s;
+    fx1, fy1, fx2, fy2, fe_x, fe_y = format_coords(x1, y1, x2, y2, abs(x2 - x1) * e_per_mm, abs(y2 - y1) * e_per_mm);
+
     # travel to far x side of origin
     # (we want to end there so that we don't wipe the nozzle over the print)
-    gcode += generate_travel(far_x - s, origin_y + s);
-
-    gcode += generate_deretract();
+    if travel is None:
+        travel = generate_travel(x2, y1);
+        start = head_state();
+    else:
+        gcode.append(generate_travel(x2, y1));
 
     # outer shell
-    gcode += generate_extrude_line(far_x - s,    far_y - s, feed_o);
-    gcode += generate_extrude_line(origin_x + s, far_y - s, feed_o);
-    gcode += generate_extrude_line(origin_x + s, origin_y + s, feed_o);
+    gcode.append("G1 X" + fx2 + " Y" + fy2 + " E" + fe_y + feed_o);
+    gcode.append("G1 X" + fx1 + " Y" + fy2 + " E" + fe_x + feed_o);
+    gcode.append("G1 X" + fx1 + " Y" + fy1 + " E" + fe_y + feed_o);
 
     # note: coasting would be implemented by splitting this line
     # to extrude and travel
-    gcode += generate_extrude_line(far_x - s,    origin_y + s, feed_o);
+    gcode.append("G1 X" + fx2 + " Y" + fy1 + " E" + fe_x + feed_o);
     # note: wipe would be implemented by doing travel in direction of origin_x + s, origin_y + s, with distance being governed by wipe distance
-    return gcode;
+
+    settings["pos_x"] = x2;
+    settings["pos_y"] = y1;
+    return (travel, "".join(gcode), start, head_state());
+
+# returns the parts of the g-code for the shape of the current tile, to be
+# put in the layer's list as they are
+# shape is the tile's tuple from render_shape(), None for the brim
+def generate_shape(shape):
+    # first layer contains brim
+    if shape is None:
+        return generate_brim();
+
+    travel, extrusion, start, end = shape;
+
+    # de-retract after traveling to the shape, with the head position set
+    # the way it would be if the shape was generated right here
+    settings.update(start);
+    deretract = generate_deretract();
+    settings.update(end);
+    return (travel, deretract, extrusion);
+
+# generates all the tiles of the current layer
+def generate_layer(z_tile):
+    steps_x = settings["steps_x"];
+    tile_prologues = TILE_PROLOGUE_STR[z_tile];
+    gcode = [];
+    extend = gcode.extend;
+
+    # the shapes only change with the layer, so pick their table just once
+    # first layer contains brim, z tile intro has a small shrink in shape to serve as marker
+    if settings["layer"] == 0:
+        shapes = None;
+    elif settings["z_tile_intro"]:
+        shapes = SHAPE_STR_INTRO;
+    else:
+        shapes = SHAPE_STR;
+
+    # Y tiles
+    for y_tile in range(0, settings["steps_y"]):
+        prologues = tile_prologues[y_tile];
+        row = shapes[y_tile] if shapes else None;
+        for x_tile in range(0, steps_x):
+            # origin for the current tile is recalculated
+            recalculate_tile_settings(x_tile,y_tile,z_tile);
+            # intro G-code for the tile, the G-code for the tile - contains
+            # deretraction as appropriate - and the retraction code
+            extend((prologues[x_tile], "\n",
+                    *generate_shape(row[x_tile] if row else None), "\n",
+                    generate_retract(), "\n"));
+
+    return "".join(gcode);
 
 ################################################################################
 ### Utilities ##################################################################
@@ -472,28 +771,28 @@ def sanity_check():
 
 def print_retraction_map():
     # print a helpful guide for retraction tracking
-    print("; ==== retraction map ====");
-    print("; ");
-    print(";  Y (retr. speed)");
-    print(";  ^ ");
-    print("; 0,0 > X (retr. distance)");
-    print("; ");
+    output("; ==== retraction map ====");
+    output("; ");
+    output(";  Y (retr. speed)");
+    output(";  ^ ");
+    output("; 0,0 > X (retr. distance)");
+    output("; ");
     for y in reversed(range(0, settings["steps_y"])):
         spd = settings["ret_spd_start"] + settings["ret_spd_step"] * y;
         line = "; [%2d] %2.2f mm/s :  [ 1]" % (y + 1, spd);
         for x in range(1, settings["steps_x"]):
             dist = settings["ret_d_start"] + settings["ret_d_step"] * (x-1);
             line += " .. %3.1f mm .. [%2d]" % (dist, x + 1);
-        print(line);
-    print("; ");
-    print("; Z: (print temp.)");
+        output(line);
+    output("; ");
+    output("; Z: (print temp.)");
     for z in reversed(range(0, settings["steps_z"])):
         temp = settings["ret_temp_start"] + settings["ret_temp_step"] * z;
         height = z * settings["ret_temp_step_h"] * settings["layer_height"];
-        print("; [%2d] - %3.2f mm - %3.2f C" % (z + 1, height, temp));
+        output("; [%2d] - %3.2f mm - %3.2f C" % (z + 1, height, temp));
 
-    print("; ========================");
-    print("");
+    output("; ========================");
+    output("");
 
 ################################################################################
 ### Main code ##################################################################
@@ -501,6 +800,16 @@ def print_retraction_map():
 # this calculates helper constants so that we know where to place the pillars
 recalculate_constants();
 
+# feedrates stay the same for the whole print, so their g-code is formatted once
+TRAVEL_FEED_CMD = " F%s ; travel\n" % settings["feed_travel"];
+PRINT_FEED_CMD  = " F%.6f\n" % settings["feed_print"];
+OUTER_FEED_CMD  = " F%.6f\n" % settings["feed_print_outer"];
+FIRST_FEED_CMD  = " F%.6f\n" % settings["feed_print_first"];
+
+# same for the fan speed of the first and the other layers
+FAN_CMD_LAYER0 = fan_cmd(settings["fan_spd_initial"]);
+FAN_CMD_OTHER  = fan_cmd(settings["fan_spd_other"]);
+
 # sanity check
 sanity_check();
 
@@ -509,16 +818,28 @@ sanity_check();
 s = "\n".join([(";   %s = %s" % (i[0], comment(i[1]))) for i in settings.items()]);
 settings["settings"] = s;
 
-# we retract in the next statement, so we prepare for zero tile
-recalculate_tile_settings(0,0,0);
-
 print_retraction_map();
 
 # generate the prologue
-print(gcode_prologue.substitute(settings));
+output(gcode_prologue.format_map(settings));
+
+# when true, the generated layers are templates of the per-layer settings
+layer_template = prerender_tiles();
+
+# we retract in the next statement, so we prepare for zero tile
+recalculate_tile_settings(0,0,0);
 
 # retract since we'll be traveling to first tile and de-retracting
-print(generate_retract())
+if layer_template:
+    output(generate_retract().format_map(settings))
+else:
+    output(generate_retract())
+
+prerender_layers();
+
+# with the retraction g-code prerendered per tile, all the layers of a z tile
+# (apart from the brim and the z tile intro) consist of the same tiles
+layer_cacheable = bool(RETRACT_STR) and bool(DERETRACT_STR);
 
 # generate the retraction pattern
 for z_tile in range(0, settings["steps_z"]):
@@ -527,32 +848,43 @@ for z_tile in range(0, settings["steps_z"]):
 
     # calculate the current temp
     recalculate_z_tile(z_tile);
-    print(z_tile_prologue.substitute(settings));
+    output(z_tile_prologue.format_map(settings));
+
+    # tiles of a regular layer of this z tile, once generated
+    layer_tiles = None;
 
     # n layers of the current Z tile
     z_tile_layers = settings["ret_temp_step_h"];
     for z_layer in range(0, z_tile_layers):
         # recalculate the z coord
         recalculate_layer(z_tile_layers * z_tile + z_layer);
-        print(z_layer_prologue.substitute(settings));
-
-        # Y tiles
-        for y_tile in range(0, settings["steps_y"]):
-            for x_tile in range(0, settings["steps_x"]):
-                # origin for the current tile is recalculated
-                recalculate_tile_settings(x_tile,y_tile,z_tile);
-                # intro G-code for the tile
-                print(tile_prologue.substitute(settings));
-                # generate the G-code for the tile - contains deretraction as appropriate
-                print(generate_shape())
-                # generate the retraction code
-                print(generate_retract())
+        output(LAYER_PROLOGUE_STR[settings["layer"]]);
+
+        if layer_tiles is not None:
+            tiles = layer_tiles;
+        else:
+            tiles = generate_layer(z_tile);
+            if layer_template:
+                tiles = compile_template(tiles);
+            # every layer ends on the same tile, so the retraction state
+            # at the start of the next layer is the same as well
+            if layer_cacheable and settings["layer"] != 0 and not settings["z_tile_intro"]:
+                layer_tiles = tiles;
+
+        if layer_template:
+            tiles = render_compiled(tiles);
+        out.append(tiles);
 
         # not a z intro any more
         settings["z_tile_intro"] = False;
 
+    # one write per z tile, so that the whole print is never held in memory
+    flush_output();
+
 # TODO: this could crash the z if it is too high
 # park 5 mm above the print
 settings["park_z"] = settings["coord_z"] + 5
 
-print(gcode_epilogue.substitute(settings));
+output(gcode_epilogue.format_map(settings));
+
+flush_output();